@@ -1,7 +1,11 @@
 import sys
+from collections import defaultdict, deque
 
 from crossword import *
 
+# maximum number of failed subproblems remembered by backtrack
+MAX_CACHE_LENGTH = 100000
+
 
 class CrosswordCreator():
 
@@ -10,25 +14,73 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+        # domains are frozensets, replaced rather than mutated on revision
+        words = frozenset(self.crossword.words)
         self.domains = {
-            var: self.crossword.words.copy()
+            var: words
             for var in self.crossword.variables
         }
+        # bucket vocabulary by word length once for node consistency
+        by_len = {}
+        for word in self.crossword.words:
+            by_len.setdefault(len(word), set()).add(word)
+        self._by_len = {n: frozenset(ws) for n, ws in by_len.items()}
+        # backtrack works on integer word ids, sorted by length and then
+        # alphabetically so each length is a contiguous run of ids starting
+        # at _len_offset[length]; strings only reappear in the assignment
+        self._word = sorted(self.crossword.words, key=lambda w: (len(w), w))
+        self._id = {w: k for k, w in enumerate(self._word)}
+        # domains are int bitmasks within each length's run, where bit k is
+        # word id _len_offset[length] + k; _pos_bits[length][p][c] marks the
+        # words with letter c at position p
+        self._len_offset = {}
+        self._pos_bits = {}
+        for n in {v.length for v in self.crossword.variables}:
+            ws = sorted(self._by_len.get(n, ()))
+            self._len_offset[n] = self._id[ws[0]] if ws else 0
+            self._pos_bits[n] = [defaultdict(int) for _ in range(n)]
+            for k, w in enumerate(ws):
+                for p, c in enumerate(w):
+                    self._pos_bits[n][p][c] |= 1 << k
+        # neighbors and degree of each variable never change, so cache them
+        self._neighbors = {
+            v: frozenset(self.crossword.neighbors(v))
+            for v in self.crossword.variables
+        }
+        self._degree = {v: len(ns) for v, ns in self._neighbors.items()}
+        # the structure is fixed once loaded, so specialize each variable's
+        # constraints up front: for every neighbor n store the overlap
+        # (i, j), n's letter bitmasks at j and whether n shares v's length
+        # (so shares its bits), saving table lookups in the search loop
+        self._constraints = {}
+        for v, ns in self._neighbors.items():
+            constraints = []
+            for n in ns:
+                i, j = self.crossword.overlaps[v, n]
+                constraints.append((
+                    n, i, j,
+                    self._pos_bits[n.length][j],
+                    n.length == v.length
+                ))
+            self._constraints[v] = tuple(constraints)
+        # subproblems backtrack has already proven unsolvable
+        self._failcache = set()
+        # lazily built letter-position index for revise, keyed by (var, pos)
+        self._index = {}
 
     def letter_grid(self, assignment):
         """
-        Return 2D array representing a given assignment.
+        Return flat row-major list representing a given assignment;
+        the letter in cell (i, j) is at index i * width + j.
         """
-        letters = [
-            [None for _ in range(self.crossword.width)]
-            for _ in range(self.crossword.height)
-        ]
+        width = self.crossword.width
+        letters = [None] * (self.crossword.height * width)
         for variable, word in assignment.items():
-            direction = variable.direction
-            for k in range(len(word)):
-                i = variable.i + (k if direction == Variable.DOWN else 0)
-                j = variable.j + (k if direction == Variable.ACROSS else 0)
-                letters[i][j] = word[k]
+            # decide the direction once: down words step a whole row,
+            # across words step one cell, then write the word in one slice
+            step = width if variable.direction == Variable.DOWN else 1
+            start = variable.i * width + variable.j
+            letters[start:start + step * len(word):step] = word
         return letters
 
     def print(self, assignment):
@@ -36,10 +88,11 @@ class CrosswordCreator():
         Print crossword assignment to the terminal.
         """
         letters = self.letter_grid(assignment)
+        width = self.crossword.width
         for i in range(self.crossword.height):
-            for j in range(self.crossword.width):
+            for j in range(width):
                 if self.crossword.structure[i][j]:
-                    print(letters[i][j] or " ", end="")
+                    print(letters[i * width + j] or " ", end="")
                 else:
                     print("█", end="")
             print()
@@ -75,12 +128,13 @@ class CrosswordCreator():
                 ]
                 if self.crossword.structure[i][j]:
                     draw.rectangle(rect, fill="white")
-                    if letters[i][j]:
-                        w, h = draw.textsize(letters[i][j], font=font)
+                    letter = letters[i * self.crossword.width + j]
+                    if letter:
+                        w, h = draw.textsize(letter, font=font)
                         draw.text(
                             (rect[0][0] + ((interior_size - w) / 2),
                              rect[0][1] + ((interior_size - h) / 2) - 10),
-                            letters[i][j], fill="black", font=font
+                            letter, fill="black", font=font
                         )
 
         img.save(filename)
@@ -99,41 +153,9 @@ class CrosswordCreator():
         (Remove any values that are inconsistent with a variable's unary
          constraints; in this case, the length of the word.)
         """
-        for var, words in self.domains.items():
-            for test_word in words.copy():
-                if var.length != len(test_word):
-                    words.remove(test_word)
-
-    def compare_domain(x, y, xwords, ywords):
-        """
-        This static method is used to compare the domains of
-        two variables that overlap at (x, y). xwords and ywords
-        are sets of words for the x and y variables. Returns
-        a new set of words for the x variable. Called by 
-        revise.
-        """
-        # go through each word in x domain
-        # see if consistent with some word in y domain
-        for xword in xwords.copy():
-            consistent = False
-            if len(xword) < x:
-                # too short to be consistent
-                continue
-            for yword in ywords:
-                if len(yword) < y or xword == yword:
-                    # too short or same word - not consistent
-                    continue
-                # now compare overlapping character
-                consistent = (xword[x] == yword[y])
-                if consistent:
-                    # we're done with that xword once we find a 
-                    # consistent yword
-                    break
-            # now we've compared all ywords for the xword
-            if not consistent:
-                # must remove xword if no ywords were consistent
-                xwords.remove(xword)
-        return xwords
+        # each domain is just the bucket of words of the matching length
+        for var in self.domains:
+            self.set_domain(var, self._by_len.get(var.length, frozenset()))
 
     def revise(self, x, y):
         """
@@ -149,14 +171,76 @@ class CrosswordCreator():
         if not o:
             # no overlap - can't be inconsistent
             return False
-        # else go through each word in x domain
-        # see if consistent with some word in y domain
-        new_xwords = CrosswordCreator.compare_domain(o[0], o[1], self.domains[x].copy(), 
-                                                     self.domains[y])
-        revised = (len(new_xwords) != len(self.domains[x]))
-        if revised:
-            self.domains[x] = new_xwords
-        return revised
+        i, j = o
+        xidx = self.letter_index(x, i)
+        yidx = self.letter_index(y, j)
+        # work a whole letter at a time over the distinct letters both
+        # sides share: keep every xword whose overlap letter appears in
+        # some yword, except an xword whose only supporting yword is itself
+        # (subtracted from this letter's xwords only, not from all of keep)
+        keep = set()
+        for letter in xidx.keys() & yidx.keys():
+            ywords = yidx[letter]
+            keep |= xidx[letter] - ywords if len(ywords) == 1 else xidx[letter]
+        if len(keep) != len(self.domains[x]):
+            self.set_domain(x, frozenset(keep))
+            return True
+        return False
+
+    def letter_index(self, var, pos):
+        """
+        Return dict mapping each letter to the set of words in the domain
+        of `var` having that letter at position `pos`. The index is built
+        on first use and reused until the domain of `var` changes.
+        """
+        words = self.domains[var]
+        cached = self._index.get((var, pos))
+        # domains are replaced rather than mutated, so identity tells us
+        # whether the cached index still matches the current domain
+        if cached is not None and cached[0] is words:
+            return cached[1]
+        idx = defaultdict(set)
+        for word in words:
+            idx[word[pos]].add(word)
+        self._index[var, pos] = (words, idx)
+        return idx
+
+    def set_domain(self, var, words):
+        """
+        Replace the domain of `var` with `words`, invalidating any letter
+        indexes built from the old domain.
+        """
+        self.domains[var] = words
+        for pos in range(var.length):
+            self._index.pop((var, pos), None)
+
+    def domain_masks(self):
+        """
+        Return `self.domains` as a mapping from each variable to a bitmask
+        over the words of its length, as used by backtrack.
+        """
+        masks = {}
+        for var, words in self.domains.items():
+            offset = self._len_offset[var.length]
+            mask = 0
+            for word in words:
+                if len(word) == var.length:
+                    mask |= 1 << (self._id[word] - offset)
+            masks[var] = mask
+        return masks
+
+    def mask_ids(self, var, mask):
+        """
+        Return list of the ids of the words of `var`'s length selected
+        by `mask`.
+        """
+        offset = self._len_offset[var.length]
+        result = []
+        while mask:
+            low = mask & -mask
+            result.append(offset + low.bit_length() - 1)
+            mask ^= low
+        return result
 
     def ac3(self, arcs=None):
         """
@@ -170,15 +254,28 @@ class CrosswordCreator():
         if not arcs:
             # if empty arcs set, start with all arcs
             # go through each var and add tuple of var with all neighbors
-            arcs = set()
-            for var in self.crossword.variables:
-                arcs = arcs.union(set((var, v) for v in self.crossword.neighbors(var)))
-        while len(arcs) != 0:
-            (x, y) = arcs.pop()
+            arcs = [
+                (var, v)
+                for var in self.crossword.variables
+                for v in self._neighbors[var]
+            ]
+        # FIFO queue of arcs plus set of arcs currently queued
+        queue = deque()
+        queued = set()
+        for arc in arcs:
+            if arc not in queued:
+                queue.append(arc)
+                queued.add(arc)
+        while queue:
+            (x, y) = queue.popleft()
+            queued.discard((x, y))
             if self.revise(x, y):
                 if len(self.domains[x]) == 0:
                     return False
-                arcs = arcs.union(set((z, x) for z in (self.crossword.neighbors(x) - {y})))
+                for z in self._neighbors[x] - {y}:
+                    if (z, x) not in queued:
+                        queue.append((z, x))
+                        queued.add((z, x))
         return True
 
     def assignment_complete(self, assignment):
@@ -216,88 +313,178 @@ class CrosswordCreator():
                             return False
         return True
 
-    def order_domain_values(self, var, assignment):
+    def order_domain_values(self, var, assignment, domains=None):
         """
         Return a list of values in the domain of `var`, in order by
         the number of values they rule out for neighboring variables.
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
+        `domains` are bitmask domains as used by backtrack, defaulting
+        to `self.domains`.
         """
-        # neighbors minus vars already assigned
-        nb = self.crossword.neighbors(var) - set(assignment.keys())
+        return [
+            self._word[wid]
+            for wid in self.order_domain_ids(var, assignment, domains)
+        ]
+
+    def order_domain_ids(self, var, assignment, domains=None):
+        """
+        Same as order_domain_values, but return the word ids used by
+        backtrack instead of the words themselves.
+        """
+        if domains is None:
+            domains = self.domain_masks()
         # count number of words in neighbor domain ruled out
         # for each word in our domain
-        ruled_out = {}
-        for our_word in self.domains[var]:
-            ruled_out[our_word] = 0
-            # go through neighborhood vars
-            for nvar in nb:
-                # get overlaps for two vars (guaranteed since they're neighbors)
-                x, y = self.crossword.overlaps[var, nvar]
-                # for each one go through domain words
-                for n_word in self.domains[nvar]:
-                    # check specific letters in words
-                    # if not the same, ruled out +1
-                    if our_word[x] != n_word[y]:
-                        ruled_out[our_word] += 1
+        ruled_out = dict.fromkeys(self.mask_ids(var, domains[var]), 0)
+        # go through neighborhood vars not already assigned
+        for nvar, x, y, letter_bits, _ in self._constraints[var]:
+            if nvar in assignment:
+                continue
+            # count neighbor words with each letter at the overlap; every
+            # neighbor word without our letter there is ruled out
+            mask = domains[nvar]
+            dn = bin(mask).count("1")
+            hist = {
+                c: bin(mask & bits).count("1")
+                for c, bits in letter_bits.items()
+            }
+            for wid in ruled_out:
+                ruled_out[wid] += dn - hist.get(self._word[wid][x], 0)
         # when done, sort by ruled_out number and return
-        return sorted(self.domains[var], key=lambda word: ruled_out[word])
+        return sorted(ruled_out, key=lambda wid: ruled_out[wid])
 
-    def select_unassigned_variable(self, assignment):
+    def select_unassigned_variable(self, assignment, domains=None):
         """
         Return an unassigned variable not already part of `assignment`.
         Choose the variable with the minimum number of remaining values
         in its domain. If there is a tie, choose the variable with the highest
         degree. If there is a tie, any of the tied variables are acceptable
-        return values.
-        """
-        # figure out number of values and degree for ordering
-        # vars is all vars minus those in assignment already
-        vars = set(v for v in self.crossword.variables) - set(assignment.keys())
-        # number of values in domain
-        num_vals = {v: len(self.domains[v]) for v in vars}
-        # degree of each var
-        deg = {v: len(self.crossword.neighbors(v)) for v in vars}
-        # sort primary ascending by num_vals and then descending by degree
-        s = sorted(sorted(vars, key=lambda d: deg[d], reverse=True), 
-                   key=lambda n: num_vals[n])
-        return s[0]
-
-    def backtrack(self, assignment):
+        return values. `domains` are bitmask domains as used by backtrack,
+        defaulting to `self.domains`.
+        """
+        # number of values in domain: word sets answer directly, bitmask
+        # domains count their set bits
+        if domains is None:
+            num_vals = lambda v: len(self.domains[v])
+        else:
+            num_vals = lambda v: bin(domains[v]).count("1")
+        # one pass over the unassigned vars: fewest values first, then
+        # highest degree
+        return min(
+            (v for v in self.crossword.variables if v not in assignment),
+            key=lambda v: (num_vals(v), -self._degree[v])
+        )
+
+    def backtrack(self, assignment, domains=None, used=None):
         """
         Using Backtracking Search, take as input a partial assignment for the
         crossword and return a complete assignment if possible to do so.
         `assignment` is a mapping from variables (keys) to words (values).
+        `domains` map each variable to a bitmask over the words of its
+        length for this point of the search, defaulting to `self.domains`;
+        they are never mutated, smaller copies are passed down instead.
+        `used` is a bitmask over the ids of the words in `assignment`.
         If no assignment is possible, return None.
         """
+        if domains is None:
+            # a caller's partial assignment has not been forward checked
+            # yet, so fold it into the domains before searching
+            folded = self.assignment_masks(assignment)
+            if folded is None:
+                return None
+            domains, used = folded
+        elif used is None:
+            used = 0
+            for word in assignment.values():
+                used |= 1 << self._id[word]
         if self.assignment_complete(assignment):
             return assignment
-        var = self.select_unassigned_variable(assignment)
-        for value in self.order_domain_values(var, assignment):
-            # assign this value to assignment
-            assignment[var] = value
-            # initialize var to save domains for neighbors
-            save_domains = {}
-            # check if assignment consistent
-            if self.consistent(assignment):
-                # if so, now enforce arc consistency for neighbors but save
-                # copy of each neighbor domain first to undo if necessary
-                # n_all is all neighbors
-                n_all = self.crossword.neighbors(var)
-                save_domains = {n: self.domains[n].copy() for n in n_all}
-                arcs = set((z, var) for z in n_all)
-                if self.ac3(arcs):
-                    result = self.backtrack(assignment)
-                    # if result valid return it
-                    if result:
-                        return result
-            # not consistent - remove assignment and restore neighbor domains
+        # the remaining subproblem is fully described by the unassigned
+        # domains and the words already used, so skip known dead ends
+        key = (
+            frozenset(
+                (v, mask) for v, mask in domains.items()
+                if v not in assignment
+            ),
+            used
+        )
+        if key in self._failcache:
+            return None
+        var = self.select_unassigned_variable(assignment, domains)
+        for wid in self.order_domain_ids(var, assignment, domains):
+            # domains were forward checked against every assigned word,
+            # including any the caller passed in, so only duplicate words
+            # need checking here
+            if used >> wid & 1:
+                continue
+            new_domains = self.forward_check(var, wid, assignment, domains)
+            if new_domains is None:
+                # some neighbor has no word left - skip this value
+                continue
+            assignment[var] = self._word[wid]
+            result = self.backtrack(assignment, new_domains, used | 1 << wid)
+            # if result valid return it
+            if result:
+                return result
+            # dead end - remove assignment and try the next value
             assignment.pop(var)
-            for n, domain in save_domains.items():
-                self.domains[n] = domain
-        # we've tried all in domain, return None
-        return None    
-        
+        # we've tried all in domain, remember the dead end and return None
+        if len(self._failcache) < MAX_CACHE_LENGTH:
+            self._failcache.add(key)
+        return None
+
+    def assignment_masks(self, assignment):
+        """
+        Return `(domains, used)` for starting backtrack from `assignment`:
+        the bitmask domains of `self.domains` forward checked against every
+        word already in `assignment`, and the bitmask of those words' ids.
+        Return None if `assignment` is inconsistent (a word outside its
+        variable's domain, a repeated word, or clashing overlaps) or leaves
+        some neighbor domain empty.
+        """
+        domains = self.domain_masks()
+        used = 0
+        placed = {}
+        for var, word in assignment.items():
+            wid = self._id.get(word)
+            if wid is None or len(word) != var.length or used >> wid & 1:
+                return None
+            # earlier placements already pruned this domain to the words
+            # that agree with them at their overlaps
+            if not domains[var] >> (wid - self._len_offset[var.length]) & 1:
+                return None
+            domains = self.forward_check(var, wid, placed, domains)
+            if domains is None:
+                return None
+            placed[var] = word
+            used |= 1 << wid
+        return domains, used
+
+    def forward_check(self, var, wid, assignment, domains):
+        """
+        Return a copy of bitmask `domains` with `var` fixed to the word with
+        id `wid` and each unassigned neighbor of `var` pruned to the words
+        that agree with it at their overlap. Return None if any neighbor
+        domain ends up empty.
+        """
+        value = self._word[wid]
+        bit = 1 << (wid - self._len_offset[var.length])
+        new_domains = dict(domains)
+        new_domains[var] = bit
+        for n, i, j, letter_bits, same_length in self._constraints[var]:
+            if n in assignment:
+                continue
+            # one AND keeps the words with the right letter at the overlap,
+            # a second clears `value` itself if it has the neighbor's length
+            pruned = domains[n] & letter_bits.get(value[i], 0)
+            if same_length:
+                pruned &= ~bit
+            if not pruned:
+                return None
+            new_domains[n] = pruned
+        return new_domains
+
 
 def main():
 